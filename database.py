@@ -3,11 +3,18 @@ import logging
 import json # Necesario para serializar/deserializar JSONB
 from datetime import datetime
 
-from supabase import create_client, Client
+from threading import RLock
+
+from cachetools import TTLCache
+from supabase import create_client, Client, ClientOptions
 from dotenv import load_dotenv
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# Logger de módulo con formateo perezoso (%s): los argumentos solo se
+# formatean si el registro se emite de verdad.
+logger = logging.getLogger(__name__)
+
 load_dotenv()
 
 SUPABASE_URL = os.getenv("SUPABASE_URL")
@@ -15,27 +22,54 @@ SUPABASE_KEY = os.getenv("SUPABASE_KEY")
 
 # Asegúrate de que las variables de entorno están configuradas
 if not SUPABASE_URL or not SUPABASE_KEY:
-    logging.error("Las variables de entorno SUPABASE_URL o SUPABASE_KEY no están configuradas.")
+    logger.error("Las variables de entorno SUPABASE_URL o SUPABASE_KEY no están configuradas.")
     raise ValueError("Configuración de Supabase incompleta. Por favor, configura tu .env o variables de entorno.")
 
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+# Cliente único a nivel de módulo: el httpx interno de postgrest mantiene
+# conexiones keep-alive, así que reutilizarlo evita un handshake TLS
+# (~100-200 ms) por cada llamada. El timeout explícito evita que una llamada
+# colgada a Supabase bloquee el webhook indefinidamente.
+supabase: Client = create_client(
+    SUPABASE_URL,
+    SUPABASE_KEY,
+    options=ClientOptions(postgrest_client_timeout=10, storage_client_timeout=10)
+)
+
+# Caché en memoria de usuarios para evitar round-trips repetidos a Supabase
+# (cada llamada HTTPS cuesta cientos de ms). TTL corto para tolerar escrituras
+# hechas por otros procesos; las escrituras locales invalidan explícitamente.
+_user_cache = TTLCache(maxsize=4096, ttl=30)
+_user_cache_lock = RLock()
+
+def _invalidate_user_cache(user_id: int):
+    """Expulsa un usuario del caché tras una escritura local."""
+    with _user_cache_lock:
+        _user_cache.pop(user_id, None)
 
 # --- Funciones para la tabla 'users' ---
 def get_user(user_id: int):
-    """Obtiene datos de un usuario por su ID de Telegram."""
+    """Obtiene datos de un usuario por su ID de Telegram (con caché TTL en memoria)."""
+    with _user_cache_lock:
+        cached = _user_cache.get(user_id)
+    if cached is not None:
+        return cached
     try:
         response = supabase.table("users4").select("*").eq("user_id", user_id).execute()
         data = response.data
-        return data[0] if data else None
+        user = data[0] if data else None
+        if user is not None:
+            with _user_cache_lock:
+                _user_cache[user_id] = user
+        return user
     except Exception as e:
-        logging.error(f"Error al obtener usuario {user_id}: {e}")
+        logger.error("Error al obtener usuario %s: %s", user_id, e)
         return None
 
 def add_user(user_id: int, referred_by=None, initial_points=0):
     """Añade un nuevo usuario a la base de datos con puntos iniciales y prioridad por defecto."""
     user = get_user(user_id)
     if user:
-        logging.warning(f"Usuario {user_id} ya existe. Saltando adición.")
+        logger.warning("Usuario %s ya existe. Saltando adición.", user_id)
         return False
 
     # created_at ya no es necesario aquí si la columna en DB tiene DEFAULT NOW()
@@ -48,31 +82,35 @@ def add_user(user_id: int, referred_by=None, initial_points=0):
     try:
         response = supabase.table("users4").insert(data).execute()
         if response.data:
-            logging.info(f"Usuario {user_id} añadido a la BD. Puntos: {initial_points}, Prioridad: 2.")
+            _invalidate_user_cache(user_id)
+            logger.info("Usuario %s añadido a la BD. Puntos: %s, Prioridad: 2.", user_id, initial_points)
             return True
-        logging.warning(f"No se pudo añadir usuario {user_id}: {response.json()}.")
+        logger.warning("No se pudo añadir usuario %s: %s.", user_id, response.json())
         return False
     except Exception as e:
-        logging.warning(f"Error al añadir usuario {user_id} (puede que ya exista): {e}.")
+        logger.warning("Error al añadir usuario %s (puede que ya exista): %s.", user_id, e)
         return False
 
 def update_user_points(user_id: int, amount: int):
-    """Actualiza los puntos de un usuario."""
-    user = get_user(user_id)
-    if not user:
-        logging.warning(f"Usuario {user_id} no encontrado para actualizar puntos.")
-        return None
-
-    new_points = user["points"] + amount
+    """
+    Actualiza los puntos de un usuario de forma atómica vía RPC.
+    Requiere la función SQL en Supabase:
+      create function increment_user_points(uid bigint, delta int) returns int
+      language sql as $$
+        update users4 set points = points + delta where user_id = uid returning points
+      $$;
+    Un solo round-trip (antes eran SELECT + UPDATE) y sin carrera de lectura-modificación-escritura.
+    """
     try:
-        response = supabase.table("users4").update({"points": new_points}).eq("user_id", user_id).execute()
-        if response.data:
-            logging.info(f"Puntos de usuario {user_id} actualizados en {amount} (total: {new_points}).")
-            return response.data[0] # Retorna el usuario actualizado
-        logging.error(f"Error al actualizar puntos para el usuario {user_id}: {response.json()}.")
+        response = supabase.rpc("increment_user_points", {"uid": user_id, "delta": amount}).execute()
+        if response.data is not None:
+            _invalidate_user_cache(user_id)
+            logger.info("Puntos de usuario %s actualizados en %s (total: %s).", user_id, amount, response.data)
+            return response.data # Retorna el nuevo total de puntos
+        logger.warning("Usuario %s no encontrado para actualizar puntos.", user_id)
         return None
     except Exception as e:
-        logging.error(f"Error al actualizar puntos para el usuario {user_id}: {e}.")
+        logger.error("Error al actualizar puntos para el usuario %s: %s.", user_id, e)
         return None
 
 def get_user_points(user_id: int) -> int:
@@ -89,30 +127,121 @@ def get_user_priority(user_id: int) -> int:
 def update_user_priority(user_id: int, new_priority_level: int):
     """
     Actualiza el nivel de prioridad de un usuario si el 'new_priority_level' es "mejor" (numéricamente menor)
-    que el actual.
+    que el actual. La comparación se hace en la BD vía RPC (semántica take-min con least()).
+    Requiere la función SQL en Supabase:
+      create function lower_user_priority(uid bigint, new_prio int) returns int
+      language sql as $$
+        update users4 set priority_level = least(coalesce(priority_level, 2), new_prio)
+        where user_id = uid returning priority_level
+      $$;
     """
-    user = get_user(user_id)
-    if not user:
-        logging.warning(f"Usuario {user_id} no encontrado para actualizar prioridad.")
+    try:
+        response = supabase.rpc("lower_user_priority", {"uid": user_id, "new_prio": new_priority_level}).execute()
+        if response.data is not None:
+            _invalidate_user_cache(user_id)
+            logger.info("Prioridad del usuario %s ahora es %s (solicitada: %s).", user_id, response.data, new_priority_level)
+            return True
+        logger.warning("Usuario %s no encontrado para actualizar prioridad.", user_id)
+        return False
+    except Exception as e:
+        logger.error("Error al actualizar prioridad del usuario %s: %s.", user_id, e)
         return False
 
-    current_priority = user.get("priority_level", 2) # Obtener la prioridad actual del objeto user
-    
-    if new_priority_level < current_priority: # Si la nueva prioridad es MENOR (más alta)
-        try:
-            response = supabase.table("users4").update({'priority_level': new_priority_level}).eq('user_id', user_id).execute()
-            if response.data:
-                logging.info(f"Prioridad del usuario {user_id} actualizada de {current_priority} a {new_priority_level}.")
-                return True
-            logging.error(f"Error al actualizar prioridad del usuario {user_id}: {response.json()}.")
-            return False
-        except Exception as e:
-            logging.error(f"Error al actualizar prioridad del usuario {user_id}: {e}.")
-            return False
-    else:
-        logging.info(f"La nueva prioridad {new_priority_level} no es mejor que la actual {current_priority} para el usuario {user_id}.")
+def apply_purchase(user_id: int, delta_points: int, new_priority_level: int):
+    """
+    Aplica una compra completa (puntos + prioridad) en un solo round-trip a la BD.
+    Requiere la función SQL en Supabase:
+      create function apply_purchase(uid bigint, delta int, new_prio int) returns users4
+      language sql as $$
+        update users4
+        set points = points + delta,
+            priority_level = least(coalesce(priority_level, 2), new_prio)
+        where user_id = uid
+        returning *
+      $$;
+    Retorna la fila actualizada del usuario, o None si no existe / hubo error.
+    Además de ahorrar una llamada HTTPS, elimina la ventana en la que los puntos
+    quedan acreditados pero la actualización de prioridad falla.
+    """
+    try:
+        response = supabase.rpc("apply_purchase", {
+            "uid": user_id,
+            "delta": delta_points,
+            "new_prio": new_priority_level
+        }).execute()
+        data = response.data
+        row = data[0] if isinstance(data, list) else data
+        if row:
+            _invalidate_user_cache(user_id)
+            logger.info("Compra aplicada a usuario %s: +%s puntos (total: %s), prioridad %s.", user_id, delta_points, row['points'], row['priority_level'])
+            return row
+        logger.warning("Usuario %s no encontrado para aplicar compra.", user_id)
+        return None
+    except Exception as e:
+        logger.error("Error al aplicar compra para el usuario %s: %s.", user_id, e)
+        return None
+
+def apply_purchases_bulk(purchases):
+    """
+    Aplica varias compras (lista de tuplas (user_id, delta_points, new_priority))
+    en UN solo round-trip usando arrays paralelos + unnest.
+    Requiere la función SQL en Supabase:
+      create function apply_purchases_bulk(uids bigint[], deltas int[], prios int[]) returns void
+      language sql as $$
+        update users4 u
+        set points = u.points + p.delta,
+            priority_level = least(coalesce(u.priority_level, 2), p.prio)
+        from unnest(uids, deltas, prios) as p(uid, delta, prio)
+        where u.user_id = p.uid
+      $$;
+    Retorna True si la llamada se ejecutó sin error.
+    """
+    if not purchases:
+        return True
+    try:
+        supabase.rpc("apply_purchases_bulk", {
+            "uids": [p[0] for p in purchases],
+            "deltas": [p[1] for p in purchases],
+            "prios": [p[2] for p in purchases]
+        }).execute()
+        for user_id, _, _ in purchases:
+            _invalidate_user_cache(user_id)
+        logger.info("Lote de %d compras aplicado en un solo round-trip.", len(purchases))
+        return True
+    except Exception as e:
+        logger.error("Error al aplicar lote de %d compras: %s.", len(purchases), e)
         return False
 
+# --- Funciones para la tabla 'stripe_webhook_events' (idempotencia de webhooks) ---
+def claim_stripe_event(event_id: str, event_type: str) -> bool:
+    """
+    Intenta reclamar un evento de Stripe para procesarlo exactamente una vez.
+    Requiere la tabla:
+      create table stripe_webhook_events (
+        event_id text primary key,
+        event_type text,
+        processed_at timestamptz default now()
+      );
+    Retorna True si el evento es nuevo (se insertó la fila) y False SOLO si ya
+    fue procesado antes (Stripe reenvía eventos ante cualquier respuesta no-200).
+    Cualquier otro error (red, timeout de Supabase) se propaga: el webhook debe
+    responder 5xx para que Stripe reintente, no tragarse la compra como
+    "duplicada" y perderla para siempre.
+    """
+    try:
+        response = supabase.table("stripe_webhook_events").insert({
+            "event_id": event_id,
+            "event_type": event_type
+        }).execute()
+        return bool(response.data)
+    except Exception as e:
+        # Violación de clave primaria (código Postgres 23505) => evento duplicado
+        if "23505" in str(e) or "duplicate key" in str(e).lower():
+            logger.info("Evento de Stripe %s ya procesado anteriormente. Ignorando duplicado.", event_id)
+            return False
+        logger.error("Error al reclamar evento de Stripe %s: %s.", event_id, e)
+        raise
+
 # --- Funciones para la tabla 'generation_queue' ---
 async def add_generation_job(user_id: int, chat_id: int, message_id: int, filepath: str, workflow_content: dict, selected_workflow_name: str, priority_level: int):
     """
@@ -132,12 +261,12 @@ async def add_generation_job(user_id: int, chat_id: int, message_id: int, filepa
     try:
         response = supabase.table("generation_queue").insert(job_data).execute()
         if response.data:
-            logging.info(f"Trabajo de generación para {user_id} añadido a la cola persistente con prioridad {priority_level}. ID: {response.data[0]['id']}.")
+            logger.info("Trabajo de generación para %s añadido a la cola persistente con prioridad %s. ID: %s.", user_id, priority_level, response.data[0]['id'])
             return response.data[0]['id'] # Retorna el ID UUID del trabajo insertado
-        logging.error(f"Error al añadir trabajo de generación: {response.json()}.")
+        logger.error("Error al añadir trabajo de generación: %s.", response.json())
         return None
     except Exception as e:
-        logging.error(f"Error al añadir trabajo de generación para usuario {user_id}: {e}.")
+        logger.error("Error al añadir trabajo de generación para usuario %s: %s.", user_id, e)
         return None
 
 async def get_next_generation_job():
@@ -172,17 +301,17 @@ async def get_next_generation_job():
             .execute()
 
         if update_response.data:
-            logging.info(f"Trabajo {job_id} marcado como 'processing'.")
+            logger.info("Trabajo %s marcado como 'processing'.", job_id)
             # Deserializar 'workflow_content' de JSON string a dict antes de retornar
             job['workflow_content'] = json.loads(job['workflow_content'])
             return job
         else:
             # Si no se pudo actualizar (ej. otro worker lo tomó justo antes), se loguea y se devuelve None.
-            logging.warning(f"Trabajo {job_id} ya fue tomado o su estado cambió. Reintentando la búsqueda...")
+            logger.warning("Trabajo %s ya fue tomado o su estado cambió. Reintentando la búsqueda...", job_id)
             return None
 
     except Exception as e:
-        logging.error(f"Error al obtener o marcar trabajo de generación en cola: {e}.")
+        logger.error("Error al obtener o marcar trabajo de generación en cola: %s.", e)
         return None
 
 async def update_generation_job_status(job_id: str, status: str, output_files_urls: list = None, error_message: str = None):
@@ -203,11 +332,11 @@ async def update_generation_job_status(job_id: str, status: str, output_files_ur
     try:
         response = supabase.table("generation_queue").update(update_data).eq('id', job_id).execute()
         if response.data:
-            logging.info(f"Estado del trabajo {job_id} actualizado a {status}.")
+            logger.info("Estado del trabajo %s actualizado a %s.", job_id, status)
         else:
-            logging.error(f"Error al actualizar estado del trabajo {job_id}: {response.json()}.")
+            logger.error("Error al actualizar estado del trabajo %s: %s.", job_id, response.json())
     except Exception as e:
-        logging.error(f"Error en update_generation_job_status para {job_id}: {e}.")
+        logger.error("Error en update_generation_job_status para %s: %s.", job_id, e)
 
 async def get_uncompleted_processing_jobs():
     """
@@ -221,8 +350,8 @@ async def get_uncompleted_processing_jobs():
             .execute()
         
         if response.data:
-            logging.warning(f"Encontrados {len(response.data)} trabajos en estado 'processing' no completados tras un reinicio.")
+            logger.warning("Encontrados %d trabajos en estado 'processing' no completados tras un reinicio.", len(response.data))
         return response.data
     except Exception as e:
-        logging.error(f"Error al recuperar trabajos 'processing' no completados: {e}.")
+        logger.error("Error al recuperar trabajos 'processing' no completados: %s.", e)
         return []
@@ -1,36 +1,156 @@
+from typing import Literal, Optional
+
 from fastapi import FastAPI, Request, Header, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse, Response
+import orjson
+
+from cachetools import TTLCache
+from pydantic import BaseModel
+import asyncio
+from contextlib import asynccontextmanager
+import hashlib
+import hmac
+import time
 import stripe
 import os
+import sys
 import database  # Asegúrate de que este módulo maneja una DB en la nube (ej., Supabase)
 from dotenv import load_dotenv
 from telegram import Bot # Importa Bot para enviar mensajes de confirmación
+from telegram.request import HTTPXRequest # Pool httpx persistente para el Bot
 import logging
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-app = FastAPI()
+# Logger de módulo: evita resolver el root logger en cada llamada y permite
+# formateo perezoso con %s (solo se formatea si el nivel está habilitado).
+logger = logging.getLogger(__name__)
+
+# orjson (Rust) serializa varias veces más rápido que el json de la stdlib;
+# todas las respuestas del servidor pasan por esta subclase de ORJSONResponse,
+# tolerante con claves no-str y tipos no-JSON (datetime, UUID, objetos de
+# Stripe), que serializa vía default=str en lugar de fallar.
+class JSONResponse(ORJSONResponse):
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, default=str, option=orjson.OPT_NON_STR_KEYS)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Ciclo de vida del servidor (reemplaza a los hooks @app.on_event).
+    La validación de entorno y la construcción del Bot ocurren en el ARRANQUE,
+    no al importar el módulo: importar stripe_server es barato y nunca falla,
+    lo que acelera el fork de cada worker de uvicorn y permite importar el
+    módulo desde scripts/herramientas sin tener las variables configuradas.
+    """
+    global bot, _worker_task, _HEALTH_BYTES
+
+    # Validación de configuración, diferida del import al arranque.
+    if not stripe.api_key:
+        logger.error("La variable de entorno STRIPE_SECRET_KEY no está configurada.")
+        raise ValueError("Configuración de Stripe incompleta: STRIPE_SECRET_KEY no encontrada.")
+    if not STRIPE_WEBHOOK_SECRET:
+        logger.error("La variable de entorno STRIPE_WEBHOOK_SECRET no está configurada.")
+        # No impide el arranque, pero es necesaria para webhooks seguros.
+
+    if BOT_TOKEN:
+        # Pool httpx explícito con keep-alive y HTTP/2: los envíos a Telegram
+        # reutilizan conexiones calientes en lugar de pagar DNS + TLS por mensaje.
+        # Cada worker de uvicorn construye su propio Bot con su propio pool.
+        bot = Bot(
+            token=BOT_TOKEN,
+            request=HTTPXRequest(
+                connection_pool_size=32,
+                connect_timeout=5.0,
+                read_timeout=5.0,
+                http_version="2"
+            )
+        )
+        await bot.initialize() # Abre el pool una vez; persiste entre webhooks
+    else:
+        logger.warning("BOT_TOKEN no configurado en el backend de Stripe. Los mensajes de confirmación no se pueden enviar a Telegram.")
+
+    # Consumidor de la cola de compras por lotes.
+    _worker_task = asyncio.create_task(_purchase_worker())
+
+    # Bytes de la sonda de salud, serializados una vez (tras inicializar el Bot).
+    _HEALTH_BYTES = orjson.dumps({
+        "status": "healthy",
+        "stripe_configured": bool(stripe.api_key),
+        "webhook_secret_configured": bool(STRIPE_WEBHOOK_SECRET),
+        "bot_configured": bool(bot),
+        "project": PROJECT_IDENTIFIER
+    })
+
+    yield
+
+    # Apagado limpio: detiene el worker de lotes y cierra el pool httpx del Bot.
+    if _worker_task:
+        _worker_task.cancel()
+    if bot:
+        await bot.shutdown()
+
+app = FastAPI(lifespan=lifespan, default_response_class=JSONResponse)
 
 # Carga las variables de entorno (útil para desarrollo local, Render las inyecta directamente)
 load_dotenv() 
 
 # Configuración de Stripe con variables de entorno
 stripe.api_key = os.environ.get("STRIPE_SECRET_KEY")
+# Cliente HTTP único y asíncrono para el SDK de Stripe: reutiliza las mismas
+# conexiones keep-alive en todas las llamadas en lugar de renegociar TLS, y
+# habilita los métodos *_async (todas nuestras llamadas a la API son async).
+stripe.default_http_client = stripe.http_client.new_http_client_async_fallback()
 STRIPE_WEBHOOK_SECRET = os.environ.get("STRIPE_WEBHOOK_SECRET")
 BOT_TOKEN = os.environ.get("BOT_TOKEN") # Asegúrate de tener este valor en Render
 
-# Asegúrate de que las claves de Stripe están configuradas
-if not stripe.api_key:
-    logging.error("La variable de entorno STRIPE_SECRET_KEY no está configurada.")
-    raise ValueError("Configuración de Stripe incompleta: STRIPE_SECRET_KEY no encontrada.")
-if not STRIPE_WEBHOOK_SECRET:
-    logging.error("La variable de entorno STRIPE_WEBHOOK_SECRET no está configurada.")
-    # No es un error crítico para el inicio del servidor, pero es necesario para webhooks seguros.
+# La validación de estas claves vive en lifespan(), al arrancar el servidor.
+
+# Secreto del webhook pre-codificado a bytes UNA vez: la verificación trabaja
+# directamente sobre los bytes crudos del payload, sin el decode/encode de
+# texto por petición que hace stripe.WebhookSignature.verify_header.
+_WEBHOOK_SECRET_BYTES = STRIPE_WEBHOOK_SECRET.encode("ascii") if STRIPE_WEBHOOK_SECRET else None
+
+def _verify_stripe_signature(payload: bytes, header, tolerance: int = 300) -> bool:
+    """
+    Verifica la firma del webhook de Stripe (esquema 't=...,v1=...') sobre los
+    bytes crudos: HMAC-SHA256 de "<timestamp>.<payload>" con el secreto del
+    endpoint, comparación en tiempo constante y rechazo de timestamps fuera
+    de la tolerancia (replays viejos).
+    """
+    if not _WEBHOOK_SECRET_BYTES or not header:
+        return False
+    timestamp = None
+    signatures = []
+    for item in header.split(","):
+        key, _, value = item.strip().partition("=")
+        if key == "t":
+            timestamp = value
+        elif key == "v1":
+            signatures.append(value)
+    # isascii() además de isdigit(): isdigit acepta dígitos Unicode (p. ej.
+    # arábigos) que reventarían el encode("ascii") de más abajo.
+    if timestamp is None or not timestamp.isascii() or not timestamp.isdigit() or not signatures:
+        return False
+    if abs(time.time() - int(timestamp)) > tolerance:
+        return False
+    expected = hmac.new(
+        _WEBHOOK_SECRET_BYTES,
+        timestamp.encode("ascii") + b"." + payload,
+        hashlib.sha256
+    ).hexdigest().encode("ascii")
+    # Comparación sobre bytes: compare_digest con str lanza UnicodeEncodeError
+    # si la cabecera (latin-1) trae no-ASCII; con errors="replace" una firma
+    # malformada simplemente no coincide y respondemos 400, no 500.
+    return any(
+        hmac.compare_digest(expected, sig.encode("ascii", errors="replace"))
+        for sig in signatures
+    )
 
-# Instancia del Bot para enviar confirmaciones (si BOT_TOKEN está disponible)
-bot = Bot(token=BOT_TOKEN) if BOT_TOKEN else None
-if not bot:
-    logging.warning("BOT_TOKEN no configurado en el backend de Stripe. Los mensajes de confirmación no se pueden enviar a Telegram.")
+# Instancia del Bot para enviar confirmaciones (si BOT_TOKEN está disponible).
+# Se construye en lifespan() para que CADA worker de uvicorn tenga su propio
+# Bot con su propio pool httpx (no se comparte entre procesos).
+bot = None
 
 
 # Define tus paquetes de puntos aquí con el precio en centavos (USD)
@@ -45,159 +165,335 @@ POINT_PACKAGES = {
     # 19.99 USD (aprox 350.00 MXN) -> 35000 centavos de Peso
     "p1000": {"label": "5000 points", "amount": 40000, "points": 5000, "priority_boost": 1}
 }
+# Los paquetes son fijos, así que construimos los 'line_items' de Stripe UNA
+# vez al importar el módulo en lugar de rearmar los diccionarios anidados en
+# cada llamada a /crear-sesion. No se mutan nunca por petición.
+_LINE_ITEMS = {
+    paquete_id: [{
+        "price_data": {
+            "currency": "mxn",
+            "unit_amount": paquete["amount"],
+            "product_data": {
+                "name": paquete["label"]
+            }
+        },
+        "quantity": 1
+    }]
+    for paquete_id, paquete in POINT_PACKAGES.items()
+}
+
 # --- CAMBIO 1: Define el identificador único para este proyecto ---
 # Esto es crucial para el filtrado de webhooks.
-PROJECT_IDENTIFIER = "monkeyimagenesbot" # <--- ¡IMPORTANTE! Este es el identificador para el backend de "Monkeyvideos"
+# sys.intern: las comparaciones == contra el identificador (dos por webhook,
+# en el peek pre-HMAC y el filtrado post-verificación) cortocircuitan por
+# identidad de puntero cuando el string coincide, sin comparar byte a byte.
+PROJECT_IDENTIFIER = sys.intern("monkeyimagenesbot") # <--- ¡IMPORTANTE! Este es el identificador para el backend de "Monkeyvideos"
+
+# Primera línea de idempotencia: caché local de event.id ya vistos por ESTE
+# worker. Un duplicado que cae aquí ni siquiera paga el round-trip a la tabla
+# stripe_webhook_events (que sigue siendo la barrera entre workers/replicas).
+_seen_events = TTLCache(maxsize=10_000, ttl=24 * 3600)
+_seen_events_lock = asyncio.Lock()
+
+# Esqueleto del metadata de checkout: los campos fijos viven en una sola
+# plantilla y cada petición solo añade los suyos con un merge ({**base, ...}).
+_META_TEMPLATE = {"project": PROJECT_IDENTIFIER}
+
+# Respuestas constantes del webhook, serializadas UNA vez al importar. Los
+# eventos ignorados/duplicados (la mayoría bajo ráfagas de Stripe) responden
+# sin volver a codificar JSON. Las respuestas son inmutables y reutilizables.
+_IGNORED_EVENT_TYPE_RESPONSE = JSONResponse(status_code=200, content={"status": "ignored", "reason": "event_type"})
+_IGNORED_PROJECT_RESPONSE = JSONResponse(status_code=200, content={"status": "ignored", "reason": "project_mismatch"})
+_DUPLICATE_RESPONSE = JSONResponse(status_code=200, content={"status": "duplicate"})
+_OK_RESPONSE = JSONResponse(status_code=200, content={"status": "ok"})
+
+# Plantilla del mensaje de confirmación, compilada una vez al importar.
+# El hot path solo hace format_map con un dict pequeño por evento.
+_CONFIRM_TEMPLATE = (
+    "🎉 **¡Recarga exitosa!** <b>{points}</b> puntos han sido añadidos a tu cuenta. "
+    "Tu prioridad en la cola es ahora <b>{prio}</b> (0=Más alta)."
+)
+
+# Bytes de las sondas de salud. Los definitivos se serializan una vez en
+# lifespan() (tras inicializar el Bot). Render y los monitores de uptime
+# golpean estas rutas cada pocos segundos; así no codifican JSON en cada sonda.
+_HEALTH_BYTES = b'{"status":"starting"}'
+_ROOT_BYTES = orjson.dumps({"service": "bot_stripe", "project": PROJECT_IDENTIFIER})
+
+@app.get("/")
+async def root():
+    """Ruta raíz: responde los bytes precomputados sin codificar JSON."""
+    return Response(content=_ROOT_BYTES, media_type="application/json")
+
+@app.get("/health")
+async def health():
+    """Sonda de salud para Render/monitores: bytes precomputados en el arranque."""
+    return Response(content=_HEALTH_BYTES, media_type="application/json")
+
+class CrearSesionIn(BaseModel):
+    """Cuerpo de /crear-sesion. Pydantic valida tipos y paquete en una sola pasada (núcleo Rust)."""
+    telegram_user_id: int
+    paquete_id: Literal["p200", "p500", "p1000"] # Debe coincidir con POINT_PACKAGES
+    priority_boost: Optional[int] = None # ⬅️ Recibimos el 'priority_boost' del bot
 
 @app.post("/crear-sesion")
-async def crear_sesion(request: Request):
+async def crear_sesion(body: CrearSesionIn):
     """
     Endpoint para crear una sesión de pago de Stripe.
     Llamado desde tu bot de Telegram.
+    La validación manual (.get() + isinstance) la hace ahora Pydantic, que
+    responde 422 automáticamente ante datos inválidos sin tocar Stripe.
     """
-    data = await request.json()
-    user_id = str(data.get("telegram_user_id"))
-    paquete_id = data.get("paquete_id")
-    # ⬅️ Recibimos el 'priority_boost' del bot
-    priority_boost = data.get("priority_boost") 
-
-    # Validación
-    if not user_id or paquete_id not in POINT_PACKAGES:
-        logging.error(f"Datos inválidos en /crear-sesion: user_id={user_id}, paquete_id={paquete_id}")
-        return JSONResponse(status_code=400, content={"error": "Datos inválidos: user_id o package_id incorrecto."})
-    
-    # Valida que priority_boost sea un entero válido si se envía
-    if priority_boost is not None and not isinstance(priority_boost, int):
-        logging.error(f"Tipo de dato inválido para priority_boost: {priority_boost}")
-        return JSONResponse(status_code=400, content={"error": "Datos inválidos: priority_boost debe ser un entero."})
+    user_id = str(body.telegram_user_id) # Stripe metadata exige strings
+    paquete_id = body.paquete_id
+    priority_boost = body.priority_boost
 
     paquete = POINT_PACKAGES[paquete_id]
 
     try:
-        session = stripe.checkout.Session.create(
-            
-            line_items=[{
-                "price_data": {
-                    "currency": "mxn",
-                    "unit_amount": paquete["amount"],
-                    "product_data": {
-                        "name": paquete["label"]
-                    }
-                },
-                "quantity": 1
-            }],
+        # API asíncrona nativa del SDK de Stripe: el event loop queda libre
+        # durante el round-trip a api.stripe.com (300-800 ms) sin hilos extra.
+        session = await stripe.checkout.Session.create_async(
+            line_items=_LINE_ITEMS[paquete_id], # Precomputado al importar el módulo
             mode="payment",
             allow_promotion_codes=True,
             success_url="https://t.me/monkeyimagenesbot",  # URL de éxito para este bot
             cancel_url="https://t.me/monkeyimagenesbot",   # URL de cancelación para este bot
             metadata={
+                **_META_TEMPLATE,                    # Identificador del proyecto (filtrado de webhooks)
                 "telegram_user_id": user_id,
                 "package_id": paquete_id,
                 "points_awarded": paquete["points"], # También útil para el webhook
-                "priority_boost": priority_boost,    # ⬅️ Pasamos el 'priority_boost' en el metadata
-                "project": PROJECT_IDENTIFIER        # <--- CAMBIO 2: AÑADIDO: Identificador del proyecto
+                "priority_boost": priority_boost     # ⬅️ Pasamos el 'priority_boost' en el metadata
             }
         )
-        logging.info(f"Sesión de Stripe creada para el usuario {user_id}, paquete {paquete_id}. URL: {session.url}")
+        logger.info("Sesión de Stripe creada para el usuario %s, paquete %s. URL: %s", user_id, paquete_id, session.url)
         return {"url": session.url}
     except Exception as e:
-        logging.error(f"Error al crear la sesión de Stripe para el usuario {user_id}, paquete {paquete_id}: {e}", exc_info=True)
+        logger.error("Error al crear la sesión de Stripe para el usuario %s, paquete %s: %s", user_id, paquete_id, e, exc_info=True)
         return JSONResponse(status_code=500, content={"error": f"Error interno al crear la sesión: {str(e)}"})
 
+async def _send_confirmation(user_id: int, points_awarded: int, priority_boost: int):
+    """
+    Envía el mensaje de confirmación de compra a Telegram con reintentos.
+    Se ejecuta como tarea en segundo plano para que el webhook responda 200
+    a Stripe sin esperar a la API de Telegram (puede tardar cientos de ms).
+    """
+    for intento in range(3):
+        try:
+            await bot.send_message(
+                chat_id=user_id,
+                text=_CONFIRM_TEMPLATE.format_map({"points": points_awarded, "prio": priority_boost}),
+                parse_mode="HTML"
+            )
+            return
+        except Exception as e:
+            logger.error("Error al enviar mensaje de confirmación de Telegram para %s (intento %d/3): %s", user_id, intento + 1, e)
+            if intento < 2:
+                await asyncio.sleep(2 ** intento) # Backoff: 1s, 2s
+
+# Cola en memoria que acumula compras ya reclamadas (idempotencia hecha) para
+# aplicarlas por lotes: bajo ráfagas de Stripe, N eventos cuestan UN round-trip
+# a Supabase en lugar de N. El webhook responde 200 en cuanto encola.
+_purchase_queue: "asyncio.Queue[tuple[int, int, int]]" = asyncio.Queue()
+_BATCH_MAX = 50        # Tamaño máximo de lote
+_BATCH_WINDOW = 0.05   # Ventana de coalescencia en segundos
+_worker_task = None
+_confirm_tasks = set() # Referencias vivas a los envíos de Telegram en curso
+
+async def _purchase_worker():
+    """
+    Consumidor de la cola de compras: junta hasta _BATCH_MAX elementos (o los
+    que lleguen en _BATCH_WINDOW) y los aplica con database.apply_purchases_bulk.
+    Si el lote falla, reintenta cada compra individualmente para no perder ninguna.
+    """
+    while True:
+        batch = [await _purchase_queue.get()]
+        try:
+            while len(batch) < _BATCH_MAX:
+                batch.append(await asyncio.wait_for(_purchase_queue.get(), timeout=_BATCH_WINDOW))
+        except asyncio.TimeoutError:
+            pass
+
+        ok = await asyncio.to_thread(database.apply_purchases_bulk, batch)
+        if not ok:
+            # Degradación: aplica una por una para aislar la compra problemática.
+            # Las compras son de usuarios independientes, así que vuelan en
+            # paralelo con TaskGroup: latencia = max en vez de suma.
+            async with asyncio.TaskGroup() as tg:
+                for user_id, points, prio in batch:
+                    tg.create_task(asyncio.to_thread(database.apply_purchase, user_id, points, prio))
+
+        for user_id, points, prio in batch:
+            logger.info("Usuario %s recibió %s puntos por compra en Stripe (prioridad solicitada: %s).", user_id, points, prio)
+            if bot:
+                task = asyncio.create_task(_send_confirmation(user_id, points, prio))
+                _confirm_tasks.add(task)
+                task.add_done_callback(_confirm_tasks.discard)
+            else:
+                logger.warning("Advertencia: Bot de Telegram no inicializado en el backend de Stripe (¿TOKEN faltante?). No se pudo enviar la confirmación.")
+
+def _safe_int(value, default):
+    """
+    Convierte a int sin excepciones: el camino de fallo de un try/except int()
+    es ~100x más caro que esta comprobación con isdigit(). Acepta int directos
+    y strings con signo opcional; cualquier otra cosa retorna el default.
+    """
+    if isinstance(value, int):
+        return value
+    # removeprefix, no lstrip: lstrip("-") se come TODOS los guiones iniciales
+    # y dejaría pasar "--5" hacia un int() que lanza. isascii() descarta
+    # dígitos Unicode que isdigit() acepta pero int() no siempre espera igual.
+    if isinstance(value, str) and value.removeprefix("-").isdigit() and value.isascii():
+        return int(value)
+    return default
+
+async def _process_checkout_completed(metadata: dict):
+    """
+    Procesa el metadata de un 'checkout.session.completed' ya verificado y
+    reclamado: acredita puntos/prioridad y agenda la confirmación de Telegram.
+    Es el único camino de acreditación del servidor; cualquier otro despliegue
+    que comparta este backend debe pasar por aquí.
+    """
+    user_id_str = metadata.get("telegram_user_id") # Leer como string
+    package_id = metadata.get("package_id")
+
+    user_id = _safe_int(user_id_str, None)
+    if user_id is None:
+        logger.error("Webhook: user_id inválido o faltante en metadata: %s", user_id_str)
+        return JSONResponse(status_code=400, content={"status": "error", "message": "user_id inválido en metadata"})
+
+    points_awarded = _safe_int(metadata.get("points_awarded"), None) # Puntos a otorgar
+    if points_awarded is None:
+        logger.error("Webhook: points_awarded inválido o faltante en metadata: %s", metadata.get("points_awarded"))
+        points_awarded = 0 # O maneja como error si es crítico
+
+    priority_boost = _safe_int(metadata.get("priority_boost"), None) # ⬅️ Recupera el 'priority_boost'
+    if priority_boost is None:
+        logger.warning("Webhook: priority_boost inválido o faltante en metadata: %s. Usando prioridad por defecto (2).", metadata.get("priority_boost"))
+        priority_boost = 2 # Usa prioridad por defecto si no se puede convertir
+
+    if user_id is not None and package_id in POINT_PACKAGES:
+        # Encola la compra para que _purchase_worker la aplique por lotes
+        # (la idempotencia ya reclamó el evento, así que no se pierde ni duplica).
+        # La confirmación de Telegram la envía el propio worker tras aplicar el lote.
+        await _purchase_queue.put((user_id, points_awarded, priority_boost))
+    else:
+        logger.warning("Webhook recibido pero metadata incompleta o inválida: user_id=%s, package_id=%s", user_id_str, package_id)
+
+    return _OK_RESPONSE
+
+# Tope para el cuerpo del webhook: los eventos reales de Stripe pesan unos
+# pocos KB; cualquier cosa mayor es basura y se rechaza ANTES de leer el
+# cuerpo completo, de parsearlo y de calcular el HMAC sobre él.
+_MAX_WEBHOOK_BODY = 256 * 1024
+
 @app.post("/webhook/stripe")
 async def stripe_webhook(request: Request, stripe_signature: str = Header(None, alias="Stripe-Signature")):
     """
     Endpoint que recibe webhooks de Stripe.
     Es llamado por Stripe cuando ocurren eventos como 'checkout.session.completed'.
     """
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > _MAX_WEBHOOK_BODY:
+        raise HTTPException(status_code=413, detail="Payload demasiado grande")
+
     payload = await request.body()
+    if len(payload) > _MAX_WEBHOOK_BODY: # Por si el cliente mintió u omitió Content-Length
+        raise HTTPException(status_code=413, detail="Payload demasiado grande")
 
     try:
-        event = stripe.Webhook.construct_event(payload, stripe_signature, STRIPE_WEBHOOK_SECRET)
-    except stripe.error.SignatureVerificationError as e:
-        logging.error(f"Error de verificación de firma del webhook de Stripe: {e}")
-        raise HTTPException(status_code=400, detail="Firma inválida")
-    except ValueError as e:
-        logging.error(f"Error de procesamiento de payload del webhook de Stripe: {e}")
+        # Una sola pasada de parseo con orjson (Rust) sobre los bytes crudos,
+        # en lugar del json.loads de la stdlib + construcción del objeto Event
+        # que hace stripe.Webhook.construct_event. El handler solo usa acceso
+        # por claves, así que el dict plano basta.
+        event = orjson.loads(payload)
+    except ValueError as e: # orjson.JSONDecodeError hereda de ValueError
+        logger.error("Error de procesamiento de payload del webhook de Stripe: %s", e)
+        raise HTTPException(status_code=400, detail="Payload inválido")
+
+    # Peek ANTES del HMAC: si el metadata declara explícitamente OTRO proyecto
+    # (cuenta de Stripe compartida entre bots), no gastamos HMAC-SHA256 sobre
+    # todo el payload solo para descartarlo. Es seguro sin verificar la firma
+    # porque respondemos 200 sin ningún efecto secundario.
+    if not isinstance(event, dict):
         raise HTTPException(status_code=400, detail="Payload inválido")
-    
-    # --- CAMBIO 3: INICIO DE LA LÓGICA DE FILTRADO POR METADATA DENTRO DEL WEBHOOK ---
-    # Si el evento es de tipo 'checkout.session.completed', verificamos el metadata 'project'.
+    # Cada nivel puede ser cualquier cosa (el payload aún NO está verificado):
+    # si no es dict, el peek simplemente no concluye nada y seguimos a la firma.
+    _peek_data = event.get("data")
+    _peek_obj = _peek_data.get("object") if isinstance(_peek_data, dict) else None
+    _peek_meta = _peek_obj.get("metadata") if isinstance(_peek_obj, dict) else None
+    _peek_project = _peek_meta.get("project") if isinstance(_peek_meta, dict) else None
+    if _peek_project is not None and _peek_project != PROJECT_IDENTIFIER:
+        return _IGNORED_PROJECT_RESPONSE
+
+    # tolerance=300 (default de _verify_stripe_signature): rechaza firmas con
+    # timestamp de más de 5 minutos, cortando replays viejos antes de cualquier
+    # acceso a la BD. El HMAC se calcula UNA sola vez aquí, directo sobre los
+    # bytes crudos; para idempotencia reutilizamos event["id"] en lugar de
+    # volver a hashear el payload.
+    if not _verify_stripe_signature(payload, stripe_signature):
+        logger.error("Error de verificación de firma del webhook de Stripe.")
+        raise HTTPException(status_code=400, detail="Firma inválida")
+
+
+    # Salida temprana: solo nos interesa 'checkout.session.completed'. Así los
+    # demás tipos de evento no tocan metadata ni asignan diccionarios.
+    if event["type"] != "checkout.session.completed":
+        return _IGNORED_EVENT_TYPE_RESPONSE
+
+    # Extraemos session y metadata UNA sola vez para todo el handler.
+    session = event["data"]["object"]
+    metadata = session.get("metadata") or {}
+
+    # --- FILTRADO POR METADATA: verificamos el metadata 'project'. ---
     # Si el evento no tiene el metadata 'project' o no coincide con este backend, lo ignoramos.
-    if event["type"] == "checkout.session.completed":
-        session_metadata = event["data"]["object"].get("metadata", {})
-        event_project = session_metadata.get("project")
-
-        # Verifica si el identificador del proyecto en el metadata del evento
-        # NO coincide con el identificador de ESTE backend.
-        if event_project != PROJECT_IDENTIFIER:
-            logging.info(f"Webhook recibido para el proyecto '{event_project}', pero este backend es '{PROJECT_IDENTIFIER}'. Ignorando evento.")
-            # Es crucial devolver un 200 OK para que Stripe no reintente el envío.
-            return JSONResponse(status_code=200, content={"status": "ignored", "reason": "project_mismatch"})
-    # --- FIN DE LA LÓGICA DE FILTRADO POR METADATA ---
-
-    # El resto del código del webhook solo se ejecuta si el filtro pasó (es decir, el evento es para este proyecto)
-    # Handle checkout session completed event
-    if event["type"] == "checkout.session.completed": # Esta condición se repite, pero es para claridad después del filtro.
-        session = event["data"]["object"]
-        metadata = session.get("metadata", {})
-        user_id_str = metadata.get("telegram_user_id") # Leer como string
-        package_id = metadata.get("package_id")
-        points_awarded = metadata.get("points_awarded") # Puntos a otorgar
-        priority_boost = metadata.get("priority_boost") # ⬅️ Recupera el 'priority_boost'
-
-        # Convierte user_id a int de forma segura
-        try:
-            user_id = int(user_id_str)
-        except (ValueError, TypeError):
-            logging.error(f"Webhook: user_id inválido o faltante en metadata: {user_id_str}")
-            return JSONResponse(status_code=400, content={"status": "error", "message": "user_id inválido en metadata"})
+    event_project = metadata.get("project")
+    if event_project != PROJECT_IDENTIFIER:
+        logger.debug("Webhook recibido para el proyecto '%s', pero este backend es '%s'. Ignorando evento.", event_project, PROJECT_IDENTIFIER)
+        # Es crucial devolver un 200 OK para que Stripe no reintente el envío.
+        return _IGNORED_PROJECT_RESPONSE
 
-        # Convierte points_awarded a int de forma segura
-        try:
-            points_awarded = int(points_awarded)
-        except (ValueError, TypeError):
-            logging.error(f"Webhook: points_awarded inválido o faltante en metadata: {points_awarded}")
-            points_awarded = 0 # O maneja como error si es crítico
+    # --- IDEMPOTENCIA: Stripe reenvía eventos ante cualquier no-200 o "Resend" manual. ---
+    # Primero el caché local (gratis); luego reclamamos el event.id en la tabla
+    # stripe_webhook_events, que es la barrera real entre workers/replicas. Si
+    # ya existía, respondemos 200 sin volver a acreditar puntos.
+    event_id = event["id"]
+    async with _seen_events_lock:
+        if event_id in _seen_events:
+            return _DUPLICATE_RESPONSE
 
-        # Convierte priority_boost a int de forma segura
-        try:
-            priority_boost = int(priority_boost)
-        except (ValueError, TypeError):
-            logging.warning(f"Webhook: priority_boost inválido o faltante en metadata: {priority_boost}. Usando prioridad por defecto (2).")
-            priority_boost = 2 # Usa prioridad por defecto si no se puede convertir
-
-        if user_id is not None and package_id in POINT_PACKAGES:
-            try:
-                # Actualiza los puntos del usuario
-                # Asegúrate de que tu database.py para Monkeyvideos usa la tabla correcta (ej. "users")
-                database.update_user_points(user_id, points_awarded)
-                logging.info(f"Usuario {user_id} recibió {points_awarded} puntos por compra en Stripe.")
-
-                # ⬅️ Actualiza la prioridad del usuario
-                # Solo actualizamos si la nueva prioridad es "mejor" (numéricamente menor)
-                database.update_user_priority(user_id, priority_boost)
-                logging.info(f"Prioridad del usuario {user_id} actualizada a {priority_boost} (if better).")
-
-                # Envía mensaje de confirmación al usuario de Telegram
-                if bot: # Solo intenta enviar si el bot se inicializó correctamente
-                    try:
-                        await bot.send_message(
-                            chat_id=user_id,
-                            text=f"🎉 **¡Recarga exitosa!** <b>{points_awarded}</b> puntos han sido añadidos a tu cuenta. Tu prioridad en la cola es ahora <b>{priority_boost}</b> (0=Más alta).",
-                            parse_mode="HTML"
-                        )
-                    except Exception as e:
-                        logging.error(f"Error al enviar mensaje de confirmación de Telegram para {user_id}: {e}")
-                else:
-                    logging.warning("Advertencia: Bot de Telegram no inicializado en el backend de Stripe (¿TOKEN faltante?). No se pudo enviar la confirmación.")
-            except Exception as e:
-                logging.error(f"Error al actualizar puntos/prioridad o enviar confirmación para {user_id}: {e}", exc_info=True)
-        else:
-            logging.warning(f"Webhook recibido pero metadata incompleta o inválida: user_id={user_id_str}, package_id={package_id}")
-
-    # Puedes manejar otros tipos de eventos de Stripe aquí si es necesario
-    # elif event["type"] == "payment_intent.succeeded":
-    #     logging.info("¡Payment Intent exitoso!")
-
-    return JSONResponse(status_code=200, content={"status": "ok"})
+    # database usa el cliente síncrono de supabase-py: se ejecuta en un hilo
+    # para no bloquear el event loop de uvicorn (cada llamada puede tardar cientos de ms).
+    try:
+        claimed = await asyncio.to_thread(database.claim_stripe_event, event_id, event["type"])
+    except Exception as e:
+        # Error transitorio (red, timeout de Supabase): respondemos 5xx para
+        # que Stripe reintente el evento en lugar de perder la compra.
+        logger.error("Error al reclamar el evento de Stripe %s: %s", event_id, e, exc_info=True)
+        raise HTTPException(status_code=503, detail="Error temporal al registrar el evento")
+    if not claimed:
+        async with _seen_events_lock:
+            _seen_events[event_id] = True
+        return _DUPLICATE_RESPONSE
+
+    async with _seen_events_lock:
+        _seen_events[event_id] = True
+
+    return await _process_checkout_completed(metadata)
+
+if __name__ == "__main__":
+    # Arranque local / Render: varios workers con el event loop de uvloop y el
+    # parser HTTP de httptools (ambos en C, via uvicorn[standard]). Bajo ráfagas
+    # de reintentos de Stripe los webhooks ya no se serializan tras un solo proceso.
+    import uvicorn
+    uvicorn.run(
+        "stripe_server:app",
+        host="0.0.0.0",
+        port=int(os.environ.get("PORT", 8000)),
+        workers=int(os.environ.get("WEB_CONCURRENCY", 4)),
+        loop="uvloop",
+        http="httptools",
+        proxy_headers=True,
+        access_log=False # Evita formatear una línea de log por petición; los éxitos ya se loguean donde importa
+    )